@@ -1,29 +1,81 @@
+import errno
+import io
+import ntpath
+import json
 import os
 import re
-import requests
-import gradio as gr
+import shutil
 from modules import script_callbacks, shared
 import time
+import threading
+import queue
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from collections import deque
 from datetime import datetime
+from urllib.parse import unquote, urlparse
+from urllib.request import url2pathname
+
+# 同時ダウンロード数（UIの初期値）
+MAX_WORKERS = 5
+
+# 受信・書き込みの単位（モデルファイルは数百MB以上あるため大きめに取る）
+CHUNK_SIZE = 1 << 20
+
+# 一時ファイル(.tmp)に書き込んでから名前を変更する。
+# False にすると保存先へ直接書き込み、小さいファイルでのシステムコールを減らせるが、
+# 中断時に書きかけのファイルが残り「既存ファイルをスキップ」で完了扱いになる
+ATOMIC_WRITES = True
+
+# 4xx のうち、時間をおけば成功する可能性があるステータス（タイムアウト・レート制限）
+RETRYABLE_STATUS = (408, 429)
+
+# 画面に表示する処理状況ログの最大行数
+LOG_MAX_LINES = 5000
+
+# ワーカーからの途中経過を画面に反映する間隔（秒）
+EVENT_INTERVAL = 0.5
+
+# Content-Disposition からファイル名を取り出すパターン
+_CD_STAR = re.compile(r"filename\*=[^']*''([^;\r\n]+)")
+_CD_PLAIN = re.compile(r'filename="?([^";]+)"?')
+
+# CivitAI のモデルページURL（modelVersionId 付き）
+_CIVITAI_RE = re.compile(r'https://civitai\.com/models/\d+.*?modelVersionId=(\d+)')
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
 
 # --- ユーティリティ関数 ---
 def get_filename_from_cd(cd_header):
     if not cd_header:
         return None
-    m = re.search(r"filename\*=.*''([^;\r\n]+)", cd_header)
+    m = _CD_STAR.search(cd_header)
     if m:
-        return requests.utils.unquote(m.group(1))
-    m = re.search(r'filename="?([^";]+)"?', cd_header)
+        return unquote(m.group(1))
+    m = _CD_PLAIN.search(cd_header)
     return m.group(1) if m else None
 
+def safe_filename(name):
+    """保存先フォルダの外に書き込まないよう、ディレクトリ部分を取り除いたファイル名を返す"""
+    if not name:
+        return None
+    # "C:evil.bin" のようなドライブ相対の名前は保存先を無視して結合されるので、ドライブ部分を外す
+    name = ntpath.splitdrive(name)[1]
+    # サーバーから "../" や "\\" を含む名前が返ってきても末尾の名前だけを使う
+    name = name.replace('\\', '/').rsplit('/', 1)[-1].strip()
+    if name in ('', '.', '..'):
+        return None
+    return name
+
 def convert_civitai_url(url):
     """CivitAIのモデルページURLをダウンロードAPIのURLに変換"""
     # CivitAI モデルページのURLパターンをチェック
     # 例: https://civitai.com/models/1075693?modelVersionId=1207569
     # 例: https://civitai.com/models/1075693/model-name?modelVersionId=1207569
     
-    civitai_pattern = r'https://civitai\.com/models/\d+.*?modelVersionId=(\d+)'
-    match = re.search(civitai_pattern, url)
+    # モデルページ以外のURLは正規表現を通さずにそのまま返す
+    if 'civitai.com/models/' not in url:
+        return url
+    match = _CIVITAI_RE.search(url)
     
     if match:
         model_version_id = match.group(1)
@@ -34,25 +86,51 @@ def convert_civitai_url(url):
     # CivitAIのURLでない場合、または既にAPIのURLの場合はそのまま返す
     return url
 
+def iter_urls(lines):
+    """各行の前後の空白を除き、空行以外を返す"""
+    for line in lines:
+        s = line.strip()
+        if s:
+            yield s
+
+def parse_entry(line):
+    """1行を (URL, 保存ファイル名) に分解する。JSON Lines 形式 {"url": ..., "fname": ...} にも対応"""
+    if line.startswith('{'):
+        try:
+            rec = json.loads(line)
+        except ValueError:
+            rec = None
+        # url が文字列でない行は読めない行と同じく扱う
+        if isinstance(rec, dict) and isinstance(rec.get('url'), str) and rec['url'].strip():
+            fname = rec.get('fname')
+            return rec['url'].strip(), fname if isinstance(fname, str) else None
+    # 読めない行はそのままURLとして扱い、ダウンロード時のエラーとして表示する
+    return line, None
+
 def read_urls(txt_file, url_text):
-    """ファイルまたはテキストからURLリストを取得し、CivitAIのURLを変換"""
-    urls = []
+    """ファイルまたはテキストからURLリストを取得し、(元のURL, 変換後のURL, 指定ファイル名) を返す"""
+    entries = []
     if txt_file:
-        # Gradio の UploadedFile は .name にローカルパスを持つ
-        path = getattr(txt_file, 'name', None)
+        # Gradio 3 の UploadedFile は .name にローカルパスを持ち、Gradio 4 はパス文字列を渡す
+        path = txt_file if isinstance(txt_file, str) else getattr(txt_file, 'name', None)
         if path and os.path.isfile(path):
-            with open(path, encoding='utf-8') as f:
-                urls += [ln.strip() for ln in f if ln.strip()]
+            # BOM付きや不正なバイトを含むファイルでも処理を止めない
+            with open(path, encoding='utf-8-sig', errors='replace', buffering=1 << 16) as f:
+                entries.extend(map(parse_entry, iter_urls(f)))
     if url_text:
-        urls += [ln.strip() for ln in url_text.splitlines() if ln.strip()]
+        entries.extend(map(parse_entry, iter_urls(url_text.splitlines())))
     
     # CivitAIのURLを変換
-    converted_urls = []
-    for url in urls:
-        converted_url = convert_civitai_url(url)
-        converted_urls.append(converted_url)
+    urls = [url for url, _ in entries]
+    converted_urls = [convert_civitai_url(url) for url in urls]
     
-    return converted_urls
+    # ファイル名が指定されたURLは変換後のURLで引けるようにする（重複時は最初の指定を優先）
+    fnames = {}
+    for converted, (_, fname) in zip(converted_urls, entries):
+        if fname:
+            fnames.setdefault(converted, fname)
+    
+    return urls, converted_urls, fnames
 
 def get_civitai_api_key():
     """設定 or 環境変数から API キーを取得"""
@@ -61,13 +139,56 @@ def get_civitai_api_key():
             or os.getenv('STABLEDIFFUSION_CIVITAI_API_KEY')
            )
 
+def is_downloaded(path):
+    """ダウンロード済みのファイルがあるか（stat 1回で判定）"""
+    try:
+        # ファイルサイズが0の場合は破損とみなして再ダウンロード
+        return os.stat(path).st_size > 0
+    except FileNotFoundError:
+        return False
+
+_PREALLOCATE_UNSUPPORTED = {errno.EOPNOTSUPP, getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP), errno.EINVAL, errno.ENOSYS}
+
+def preallocate(fd, size):
+    """ファイル領域を事前に確保して断片化を抑える（容量不足などはそのまま例外にする）"""
+    try:
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except AttributeError:
+            # Windowsにはposix_fallocateが無いので、サイズ指定で確保を促す
+            os.ftruncate(fd, size)
+    except OSError as e:
+        # 対応していないファイルシステムでは何もしない
+        if e.errno not in _PREALLOCATE_UNSUPPORTED:
+            raise
+
+def write_all(fd, data):
+    """バッファを介さずに書き込む（os.write が一部しか書けなかった場合は残りを書き直す）"""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+def drop_page_cache(fd):
+    """書き込み済みのページをキャッシュから破棄するようカーネルに伝える（Linuxのみ）"""
+    if hasattr(os, 'posix_fadvise'):
+        # 未書き込み（dirty）のページは破棄されないので、先にディスクへ書き出す
+        # 書き出し時のエラー（ENOSPC等）は書き込み失敗として呼び出し元に伝える
+        if hasattr(os, 'fdatasync'):
+            os.fdatasync(fd)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
+
+_SIZE_UNITS = ('B', 'KB', 'MB', 'GB', 'TB')
+
 def format_file_size(bytes_size):
     """ファイルサイズを読みやすい形式に変換"""
-    for unit in ['B', 'KB', 'MB', 'GB']:
-        if bytes_size < 1024.0:
-            return f"{bytes_size:.1f}{unit}"
-        bytes_size /= 1024.0
-    return f"{bytes_size:.1f}TB"
+    if bytes_size < 1024:
+        return f"{bytes_size:.1f}B"
+    # ビット長から単位を決める（1024 = 2**10 ごとに単位が上がる）
+    i = min((int(bytes_size).bit_length() - 1) // 10, len(_SIZE_UNITS) - 1)
+    return f"{bytes_size / (1 << (10 * i)):.1f}{_SIZE_UNITS[i]}"
 
 def format_duration(seconds):
     """経過時間を読みやすい形式に変換"""
@@ -78,29 +199,371 @@ def format_duration(seconds):
     else:
         return f"{seconds/3600:.1f}時間"
 
+def create_session(headers):
+    """全URLで使い回すセッションを作成（接続プールでTLSハンドシェイクを再利用）"""
+    import requests
+
+    session = requests.Session()
+    session.headers.update(headers)
+    # CivitAIのAPI向けにUser-Agentを設定
+    session.headers['User-Agent'] = USER_AGENT
+    # リトライは呼び出し側で行うので、アダプタ側では行わない
+    adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+def make_request_pacer(interval):
+    """全ワーカーで共有するリクエスト間隔の調整関数を返す"""
+    lock = threading.Lock()
+    next_start = [0.0]
+
+    def pace():
+        if interval <= 0:
+            return
+        with lock:
+            now = time.monotonic()
+            wait_time = next_start[0] - now
+            next_start[0] = max(now, next_start[0]) + interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+    return pace
+
+class DiskSpace:
+    """保存先の空き容量をバッチ中キャッシュし、ダウンロード予定分を差し引いて管理する"""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.free = self._read()
+
+    def _read(self):
+        try:
+            st = os.statvfs(self.path)
+            return st.f_bavail * st.f_frsize
+        except (OSError, AttributeError):
+            # Windowsの場合、os.statvfsが使えないので容量チェックをスキップ
+            return None
+
+    def reserve(self, size):
+        """size分の空きがあれば確保して True を返す"""
+        with self.lock:
+            if self.free is None:
+                return True
+            if size > self.free:
+                return False
+            self.free -= size
+            return True
+
+    def release(self, size):
+        with self.lock:
+            if self.free is not None:
+                self.free += size
+
+    def refresh(self):
+        """容量不足エラー時などに実際の空き容量を取り直す"""
+        with self.lock:
+            self.free = self._read()
+
+class InFlightPaths:
+    """ワーカー間で書き込み中の保存先パスを管理し、同じファイルへの同時書き込みを防ぐ"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.paths = set()
+
+    def claim(self, path):
+        """path を書き込み中として登録できれば True を返す"""
+        key = os.path.normcase(os.path.abspath(path))
+        with self.lock:
+            if key in self.paths:
+                return False
+            self.paths.add(key)
+            return True
+
+    def release(self, path):
+        with self.lock:
+            self.paths.discard(os.path.normcase(os.path.abspath(path)))
+
+class DownloadCancelled(Exception):
+    """画面側で処理が中断され、転送を途中でやめる場合に送出する"""
+
 # --- ダウンロード処理 ---
-def batch_download(txt_file, url_text, dest_dir, skip_existing=True, retry_count=3, delay_between_requests=1, progress=gr.Progress()):
+def _copy_local(idx, url, total, dest_dir, skip_existing, disk_space, in_flight, preset_fname):
+    """file:// のURLをコピーする（Linuxでは shutil.copyfile がカーネル内の sendfile でコピーする）"""
+    src = url2pathname(urlparse(url).path)
+    fname = safe_filename(preset_fname) or safe_filename(os.path.basename(src)) or f'file_{idx}'
+    out_path = os.path.join(dest_dir, fname)
+    if skip_existing and is_downloaded(out_path):
+        return 'skip', fname, 0, []
+    if not in_flight.claim(out_path):
+        if skip_existing:
+            return 'skip', fname, 0, []
+        return 'error', None, 0, [f'[{idx:03d}/{total:03d}] {url}', f'  -> [重複] 同じファイル名 {fname} を別のURLが保存中のため中止']
+
+    write_path = out_path + '.tmp' if ATOMIC_WRITES else out_path
+    reserved = 0
+    try:
+        # HTTPのダウンロードと同じく、コピー元のサイズ分の空きを確保してから書き込む
+        size = os.path.getsize(src)
+        if not disk_space.reserve(size):
+            disk_space.refresh()
+            if not disk_space.reserve(size):
+                return 'error', None, 0, [f'[{idx:03d}/{total:03d}] {url}', f'  -> [容量不足] 必要:{format_file_size(size)}, 空き:{format_file_size(disk_space.free)}']
+        reserved = size
+        shutil.copyfile(src, write_path)
+        if ATOMIC_WRITES:
+            os.replace(write_path, out_path)
+        reserved = 0  # 確保した分は使用済み
+    except OSError as e:
+        if os.path.exists(write_path):
+            try:
+                os.remove(write_path)
+            except OSError:
+                pass
+        if e.errno == errno.ENOSPC:
+            # 書きかけのファイルを消した後の実際の空き容量に合わせる
+            disk_space.refresh()
+            reserved = 0
+            return 'error', None, 0, [f'[{idx:03d}/{total:03d}] {url}', f'  -> [容量不足] ディスク容量が不足しています']
+        return 'error', None, 0, [f'[{idx:03d}/{total:03d}] {url}', f'  -> [ファイルエラー] {e}']
+    finally:
+        if reserved:
+            disk_space.release(reserved)
+        in_flight.release(out_path)
+    return 'success', fname, os.path.getsize(out_path), []
+
+def _download_one(idx, url, total, dest_dir, session, skip_existing, retry_count, delay_between_requests, pace, disk_space, in_flight, notify, cancel, preset_fname=None):
+    """1件分のダウンロード（リトライ込み）。(状態, ファイル名, ダウンロードサイズ, エラーログ) を返す"""
+    import requests
+    import urllib3
+
+    if url.startswith('file://'):
+        return _copy_local(idx, url, total, dest_dir, skip_existing, disk_space, in_flight, preset_fname)
+
+    # リトライロジック
+    status = 'error'
+    fname = None
+    actual_size = 0
+    current_error_log = []  # 現在のURLのエラーログ
+    exhausted = False  # リトライを使い切ったか（途中で中止した場合は False）
+    
+    for attempt in range(retry_count + 1):
+        if attempt > 0:
+            wait_time = delay_between_requests * (2 ** (attempt - 1))  # 指数バックオフ
+            current_error_log.append(f'  -> リトライ {attempt}/{retry_count} ({wait_time}秒待機後)')
+            notify(f'[{idx:03d}/{total:03d}] リトライ {attempt}/{retry_count} ({wait_time}秒待機後)')
+            # 待機中に中断された場合はすぐに抜ける
+            cancel.wait(wait_time)
+        
+        reserved = 0
+        write_path = None
+        claimed = None
+        try:
+            if cancel.is_set():
+                raise DownloadCancelled()
+            # ファイル名の事前取得（指定が無ければURLから推測）
+            fname = safe_filename(preset_fname) or safe_filename(url.partition('?')[0].rsplit('/', 1)[-1]) or f'file_{idx}'
+            out_path = os.path.join(dest_dir, fname)
+            
+            # 既存ファイルの確認（詳細チェック）
+            if skip_existing and is_downloaded(out_path):
+                status = 'skip'
+                break
+            
+            pace()
+            if cancel.is_set():
+                raise DownloadCancelled()
+
+            # リクエスト開始（CivitAI用により長いタイムアウト）
+            # with で囲み、途中で失敗してもレスポンスを確実に閉じる
+            with session.get(url, stream=True, timeout=(15, 300), allow_redirects=True) as resp:
+                if resp.status_code >= 400:
+                    raise requests.HTTPError(f'{resp.reason} for url: {resp.url}', response=resp)
+            
+                # ファイル名の最終決定（本体の読み込み前にヘッダーだけで判定）
+                cd = resp.headers.get('content-disposition', '')
+                # ファイル名が指定されている場合はそちらを優先する
+                final_fname = fname if safe_filename(preset_fname) else safe_filename(get_filename_from_cd(cd)) or fname
+                final_out_path = os.path.join(dest_dir, final_fname)
+            
+                # 最終ファイル名での重複チェック
+                if skip_existing and final_out_path != out_path and is_downloaded(final_out_path):
+                    fname = final_fname
+                    status = 'skip'
+                    break
+            
+                out_path = final_out_path
+                fname = final_fname
+            
+                # 別のURLが同じファイル名で保存中なら、一時ファイルを共有しないよう中止する
+                if not in_flight.claim(out_path):
+                    if skip_existing:
+                        status = 'skip'
+                    else:
+                        current_error_log.append(f'  -> [重複] 同じファイル名 {fname} を別のURLが保存中のため中止')
+                    break
+                claimed = out_path
+            
+                # Content-Lengthからファイルサイズを取得
+                content_length = resp.headers.get('content-length')
+                expected_size = int(content_length) if content_length else None
+            
+                # ディスク容量チェック（バッチ開始時の空き容量から予定分を差し引いて管理）
+                if expected_size:
+                    if not disk_space.reserve(expected_size):
+                        # 他のプロセスがファイルを消した場合などに備え、実際の空き容量を取り直して1度だけ再確認する
+                        disk_space.refresh()
+                        if not disk_space.reserve(expected_size):
+                            current_error_log.append(f'  -> [容量不足] 必要:{format_file_size(expected_size)}, 空き:{format_file_size(disk_space.free)}')
+                            break
+                    reserved = expected_size
+            
+                notify(f'[{idx:03d}/{total:03d}] ダウンロード中: {fname}' + (f' ({format_file_size(expected_size)})' if expected_size else ''))
+            
+                # ファイルダウンロード（ATOMIC_WRITES の場合は一時ファイル経由）
+                write_path = out_path + '.tmp' if ATOMIC_WRITES else out_path
+            
+                # gzip等で圧縮されている場合もrawから展開済みのデータを読む
+                resp.raw.decode_content = True
+                fd = os.open(write_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o644)
+                try:
+                    if expected_size:
+                        preallocate(fd, expected_size)
+                    # 受信した1MiB単位のデータをPythonのバッファへコピーせずそのまま書き込む
+                    written = 0
+                    read = resp.raw.read
+                    while True:
+                        if cancel.is_set():
+                            raise DownloadCancelled()
+                        chunk = read(CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        write_all(fd, chunk)
+                        written += len(chunk)
+                    if expected_size:
+                        # 受信量が予定より少なかった場合に確保した余りを切り詰める
+                        os.ftruncate(fd, written)
+                    # 書き込んだモデルはこのセッション中に読み直さないので、ページキャッシュから外す
+                    drop_page_cache(fd)
+                finally:
+                    os.close(fd)
+            
+                # ダウンロード完了、一時ファイルを正式ファイルに移動
+                if ATOMIC_WRITES:
+                    os.replace(write_path, out_path)
+                write_path = None  # 完了したので削除対象から外す
+            
+                actual_size = written
+            
+                # サイズ不一致の警告
+                if expected_size and actual_size != expected_size:
+                    current_error_log.append(f'  -> 警告: サイズ不一致 (期待:{format_file_size(expected_size)}, 実際:{format_file_size(actual_size)})')
+            
+                status = 'success'
+                reserved = 0  # 確保した分は使用済み
+                break  # リトライループを抜ける
+            
+        except DownloadCancelled:
+            current_error_log.append(f'  -> [中断] 処理が中断されたため中止')
+            break  # 書きかけのファイルは finally で削除する
+        except requests.exceptions.Timeout:
+            current_error_log.append(f'  -> [タイムアウト] 試行{attempt + 1}: レスポンスが得られませんでした')
+        except requests.exceptions.ConnectionError as e:
+            current_error_log.append(f'  -> [接続エラー] 試行{attempt + 1}: {str(e)}')
+        except requests.exceptions.HTTPError as e:
+            status_code = e.response.status_code
+            # 404や401などは再試行しても結果が変わらないので、リトライせずに終了する
+            if 400 <= status_code < 500 and status_code not in RETRYABLE_STATUS:
+                current_error_log.append(f'  -> [HTTPエラー] 試行{attempt + 1}: {status_code}: {str(e)} (リトライ対象外)')
+                break
+            current_error_log.append(f'  -> [HTTPエラー] 試行{attempt + 1}: {status_code}: {str(e)}')
+        except (requests.exceptions.InvalidURL, requests.exceptions.MissingSchema, requests.exceptions.InvalidSchema) as e:
+            # URLの書き方が誤っている場合も再試行では直らない
+            current_error_log.append(f'  -> [URLエラー] {str(e)} (リトライ対象外)')
+            break
+        except requests.exceptions.RequestException as e:
+            current_error_log.append(f'  -> [リクエストエラー] 試行{attempt + 1}: {str(e)}')
+        # resp.raw から直接読むため、本文受信中のエラーは urllib3 の例外のまま届く
+        except urllib3.exceptions.ReadTimeoutError:
+            current_error_log.append(f'  -> [タイムアウト] 試行{attempt + 1}: レスポンスが得られませんでした')
+        except urllib3.exceptions.ProtocolError as e:
+            current_error_log.append(f'  -> [接続エラー] 試行{attempt + 1}: {str(e)}')
+        except urllib3.exceptions.HTTPError as e:
+            current_error_log.append(f'  -> [リクエストエラー] 試行{attempt + 1}: {str(e)}')
+        except FileNotFoundError:
+            current_error_log.append(f'  -> [ファイルエラー] 保存先フォルダにアクセスできません: {dest_dir}')
+            break  # ファイルエラーはリトライしない
+        except PermissionError:
+            current_error_log.append(f'  -> [権限エラー] ファイルの書き込み権限がありません: {out_path}')
+            break  # 権限エラーはリトライしない
+        except OSError as e:
+            if "No space left on device" in str(e):
+                disk_space.refresh()
+                current_error_log.append(f'  -> [容量不足] ディスク容量が不足しています')
+                break  # 容量不足は致命的エラー
+            else:
+                current_error_log.append(f'  -> [OSエラー] 試行{attempt + 1}: {str(e)}')
+        except Exception as e:
+            current_error_log.append(f'  -> [予期しないエラー] 試行{attempt + 1}: {type(e).__name__}: {str(e)}')
+        finally:
+            # 書き込めなかった分の確保を戻す
+            if reserved:
+                disk_space.release(reserved)
+            # 書きかけのファイルのクリーンアップ
+            if write_path and os.path.exists(write_path):
+                try:
+                    os.remove(write_path)
+                except:
+                    pass
+            if claimed:
+                in_flight.release(claimed)
+    else:
+        exhausted = True
+    
+    # エラーが発生した場合のみログに追加
+    if status == 'error':
+        if exhausted:
+            final_message = f'{retry_count}回のリトライ後も失敗'
+        elif attempt == 0:
+            final_message = 'リトライ対象外のため中止'
+        else:
+            final_message = f'{attempt}回のリトライ後、リトライ対象外のため中止'
+        current_error_log = [
+            f'[{idx:03d}/{total:03d}] {url}',
+            *current_error_log,
+            f'  -> [最終失敗] {final_message}',
+        ]
+
+    return status, fname, actual_size, current_error_log
+    
+
+def batch_download(txt_file, url_text, dest_dir, skip_existing=True, retry_count=3, delay_between_requests=1, max_workers=MAX_WORKERS, progress=None):
+    if progress is None:
+        progress = lambda *args, **kwargs: None
     start_time = time.time()
-    original_urls = []
     
-    # 元のURLリストを取得（変換前）
-    if txt_file:
-        path = getattr(txt_file, 'name', None)
-        if path and os.path.isfile(path):
-            with open(path, encoding='utf-8') as f:
-                original_urls += [ln.strip() for ln in f if ln.strip()]
-    if url_text:
-        original_urls += [ln.strip() for ln in url_text.splitlines() if ln.strip()]
+    # URLリストを取得（変換前と変換後）
+    original_urls, urls, fnames = read_urls(txt_file, url_text)
     
-    # URLを変換
-    urls = read_urls(txt_file, url_text)
+    # 同じURL（変換後）が複数回指定されている場合は最初の1件だけ残す
+    unique_urls = {}
+    for original, converted in zip(original_urls, urls):
+        unique_urls.setdefault(converted, original)
+    duplicate_count = len(urls) - len(unique_urls)
+    urls = list(unique_urls)
+    original_urls = list(unique_urls.values())
     
     if not urls:
-        return 'URLが指定されていません。ファイルかテキストで入力してください。'
+        yield 'URLが指定されていません。ファイルかテキストで入力してください。'
+        return
     if not dest_dir:
-        return '保存先フォルダを指定してください。'
+        yield '保存先フォルダを指定してください。'
+        return
     
     os.makedirs(dest_dir, exist_ok=True)
+    workers = max(1, min(int(max_workers), len(urls)))
 
     api_key = get_civitai_api_key()
     headers = {'Authorization': f'Bearer {api_key}'} if api_key else {}
@@ -114,12 +577,13 @@ def batch_download(txt_file, url_text, dest_dir, skip_existing=True, retry_count
     logs = [
         f'=== ダウンロード開始 ===',
         f'開始時刻: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}',
-        f'合計URL数: {len(urls)}',
+        f'合計URL数: {len(urls)}' + (f' (重複{duplicate_count}件を除外)' if duplicate_count else ''),
         f'保存先: {dest_dir}',
         f'API キー: {"設定済み" if api_key else "未設定（認証エラーの可能性あり）"}',
         f'既存ファイル: {"スキップ" if skip_existing else "上書き"}',
         f'リトライ回数: {retry_count}回',
         f'リクエスト間隔: {delay_between_requests}秒',
+        f'同時ダウンロード数: {workers}',
         ''
     ]
     
@@ -133,193 +597,95 @@ def batch_download(txt_file, url_text, dest_dir, skip_existing=True, retry_count
     skip_count = 0
     error_count = 0
     total_downloaded_size = 0
-    error_details = []  # エラー詳細を別途保存
+    error_logs = {}  # エラー詳細を別途保存
+    status_logs = deque(maxlen=LOG_MAX_LINES)  # 1件ごとの処理状況（古いものから捨てる）
+    events = queue.Queue()  # ワーカーからの途中経過
 
-    for idx, url in enumerate(urls, 1):
-        progress((idx - 1) / len(urls), f"処理中 {idx}/{len(urls)} (成功:{success_count}, スキップ:{skip_count}, エラー:{error_count})")
-        
-        # リトライロジック
-        success = False
-        current_error_log = []  # 現在のURLのエラーログ
-        
-        for attempt in range(retry_count + 1):
-            if attempt > 0:
-                wait_time = delay_between_requests * (2 ** (attempt - 1))  # 指数バックオフ
-                current_error_log.append(f'  -> リトライ {attempt}/{retry_count} ({wait_time}秒待機後)')
-                time.sleep(wait_time)
-            
-            try:
-                # ファイル名の事前取得（HEADリクエストで効率化）
-                fname = os.path.basename(url.split('?')[0]) or f'file_{idx}'
-                out_path = os.path.join(dest_dir, fname)
-                
-                # 既存ファイルの確認（詳細チェック）
-                if skip_existing and os.path.exists(out_path):
-                    existing_size = os.path.getsize(out_path)
-                    # ファイルサイズが0の場合は破損とみなして再ダウンロード
-                    if existing_size > 0:
-                        skip_count += 1
-                        success = True
-                        break
-                
-                # より正確なファイル名取得のためのHEADリクエスト
-                try:
-                    head_resp = requests.head(url, headers=headers, timeout=15, allow_redirects=True)
-                    if head_resp.status_code == 200:
-                        cd = head_resp.headers.get('content-disposition', '')
-                        if cd:
-                            actual_fname = get_filename_from_cd(cd)
-                            if actual_fname:
-                                fname = actual_fname
-                                out_path = os.path.join(dest_dir, fname)
-                                
-                                # HEADリクエスト後の再チェック
-                                if skip_existing and os.path.exists(out_path):
-                                    existing_size = os.path.getsize(out_path)
-                                    if existing_size > 0:
-                                        skip_count += 1
-                                        success = True
-                                        break
-                except Exception as e:
-                    # CivitAI APIの場合、HEADリクエストが失敗することがあるので無視
-                    pass
-                
-                # リクエスト開始（CivitAI APIに対応）
-                session = requests.Session()
-                session.headers.update(headers)
-                
-                # CivitAIのAPIの場合、User-Agentを追加
-                if 'civitai.com' in url:
-                    session.headers['User-Agent'] = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-                
-                resp = session.get(url, stream=True, timeout=(15, 300), allow_redirects=True)  # CivitAI用により長いタイムアウト
-                resp.raise_for_status()
-                
-                # ファイル名の最終決定
-                cd = resp.headers.get('content-disposition', '')
-                final_fname = get_filename_from_cd(cd) or fname
-                final_out_path = os.path.join(dest_dir, final_fname)
-                
-                # 最終ファイル名での重複チェック
-                if skip_existing and final_out_path != out_path and os.path.exists(final_out_path):
-                    existing_size = os.path.getsize(final_out_path)
-                    if existing_size > 0:
+    # リクエスト間隔は全ワーカー共通で管理し、転送自体は並列に行う
+    pace = make_request_pacer(delay_between_requests)
+    disk_space = DiskSpace(dest_dir)
+    in_flight = InFlightPaths()
+    progress_step = max(1, len(urls) // 100)
+    progress(0, f"処理中 0/{len(urls)}")
+    yield '\n'.join(logs)
+
+    # ヘッダー部分は途中経過の表示ごとに作り直さない
+    header_text = '\n'.join([*logs, '=== 処理状況 ===', ''])
+
+    # 画面側で中断されたときに、転送中のワーカーへ中止を伝える
+    cancel = threading.Event()
+
+    with create_session(headers) as session:
+        # 中断時に転送中のワーカーの終了を待たないよう、with を使わずに終了処理を分ける
+        executor = ThreadPoolExecutor(max_workers=workers)
+        try:
+            futures = {
+                executor.submit(_download_one, idx, url, len(urls), dest_dir, session, skip_existing, retry_count, delay_between_requests, pace, disk_space, in_flight, events.put, cancel, fnames.get(url)): idx
+                for idx, url in enumerate(urls, 1)
+            }
+            pending = set(futures)
+            done = 0
+            updated = False
+            last_yield = time.monotonic()
+            while pending:
+                # 完了を待つ間もワーカーからの途中経過（開始・リトライ）を表示する
+                finished, pending = wait(pending, timeout=EVENT_INTERVAL, return_when=FIRST_COMPLETED)
+                while not events.empty():
+                    status_logs.append(events.get_nowait())
+                    updated = True
+                for future in sorted(finished, key=futures.get):
+                    idx = futures[future]
+                    done += 1
+                    status, fname, size, current_error_log = future.result()
+                    if status == 'success':
+                        success_count += 1
+                        total_downloaded_size += size
+                        status_logs.append(f'[{idx:03d}/{len(urls):03d}] 完了: {fname} ({format_file_size(size)})')
+                    elif status == 'skip':
                         skip_count += 1
-                        resp.close()
-                        success = True
-                        break
-                
-                out_path = final_out_path
-                fname = final_fname
-                
-                # Content-Lengthからファイルサイズを取得
-                content_length = resp.headers.get('content-length')
-                expected_size = int(content_length) if content_length else None
-                
-                # ディスク容量チェック
-                if expected_size:
-                    try:
-                        disk_free = os.statvfs(dest_dir).f_bavail * os.statvfs(dest_dir).f_frsize
-                        if expected_size > disk_free:
-                            current_error_log.append(f'  -> [容量不足] 必要:{format_file_size(expected_size)}, 空き:{format_file_size(disk_free)}')
-                            error_count += 1
-                            break
-                    except (OSError, AttributeError):
-                        # Windowsの場合、os.statvfsが使えないので容量チェックをスキップ
-                        pass
-                
-                # ファイルダウンロード
-                temp_path = out_path + '.tmp'
-                
-                with open(temp_path, 'wb') as f:
-                    for chunk in resp.iter_content(8192):
-                        if chunk:
-                            f.write(chunk)
-                
-                # ダウンロード完了、一時ファイルを正式ファイルに移動
-                os.rename(temp_path, out_path)
-                
-                actual_size = os.path.getsize(out_path)
-                
-                # サイズ不一致の警告
-                if expected_size and actual_size != expected_size:
-                    current_error_log.append(f'  -> 警告: サイズ不一致 (期待:{format_file_size(expected_size)}, 実際:{format_file_size(actual_size)})')
-                
-                success_count += 1
-                total_downloaded_size += actual_size
-                success = True
-                break  # リトライループを抜ける
-                
-            except requests.exceptions.Timeout:
-                current_error_log.append(f'  -> [タイムアウト] 試行{attempt + 1}: レスポンスが得られませんでした')
-                if attempt == retry_count:
-                    error_count += 1
-            except requests.exceptions.ConnectionError as e:
-                current_error_log.append(f'  -> [接続エラー] 試行{attempt + 1}: {str(e)}')
-                if attempt == retry_count:
-                    error_count += 1
-            except requests.exceptions.HTTPError as e:
-                current_error_log.append(f'  -> [HTTPエラー] 試行{attempt + 1}: {resp.status_code}: {str(e)}')
-                if attempt == retry_count:
-                    error_count += 1
-            except requests.exceptions.RequestException as e:
-                current_error_log.append(f'  -> [リクエストエラー] 試行{attempt + 1}: {str(e)}')
-                if attempt == retry_count:
-                    error_count += 1
-            except FileNotFoundError:
-                current_error_log.append(f'  -> [ファイルエラー] 保存先フォルダにアクセスできません: {dest_dir}')
-                error_count += 1
-                break  # ファイルエラーはリトライしない
-            except PermissionError:
-                current_error_log.append(f'  -> [権限エラー] ファイルの書き込み権限がありません: {out_path}')
-                error_count += 1
-                break  # 権限エラーはリトライしない
-            except OSError as e:
-                if "No space left on device" in str(e):
-                    current_error_log.append(f'  -> [容量不足] ディスク容量が不足しています')
-                    error_count += 1
-                    break  # 容量不足は致命的エラー
-                else:
-                    current_error_log.append(f'  -> [OSエラー] 試行{attempt + 1}: {str(e)}')
-                    if attempt == retry_count:
+                        status_logs.append(f'[{idx:03d}/{len(urls):03d}] スキップ: {fname}')
+                    else:
                         error_count += 1
-            except Exception as e:
-                current_error_log.append(f'  -> [予期しないエラー] 試行{attempt + 1}: {type(e).__name__}: {str(e)}')
-                if attempt == retry_count:
-                    error_count += 1
-            finally:
-                # 一時ファイルのクリーンアップ
-                temp_path = out_path + '.tmp' if 'out_path' in locals() else None
-                if temp_path and os.path.exists(temp_path):
-                    try:
-                        os.remove(temp_path)
-                    except:
-                        pass
-        
-        # エラーが発生した場合のみログに追加
-        if not success:
-            if not current_error_log:  # ログが空の場合
-                current_error_log = [f'[{idx:03d}/{len(urls):03d}] {url}', f'  -> [最終失敗] {retry_count}回のリトライ後も失敗']
-            else:
-                current_error_log.insert(0, f'[{idx:03d}/{len(urls):03d}] {url}')
-                current_error_log.append(f'  -> [最終失敗] {retry_count}回のリトライ後も失敗')
-            
-            error_details.extend(current_error_log)
-            error_details.append('')  # 空行で区切り
-        
-        # リクエスト間の待機
-        if idx < len(urls) and delay_between_requests > 0:
-            time.sleep(delay_between_requests)
-    
+                        error_logs[idx] = current_error_log
+                        status_logs.append(f'[{idx:03d}/{len(urls):03d}] エラー: {urls[idx - 1]}')
+                    updated = True
+                    # 進捗バーの更新は全体で100回程度に抑える
+                    if done % progress_step == 0 or done == len(urls):
+                        progress(done / len(urls), f"処理中 {done}/{len(urls)} (成功:{success_count}, スキップ:{skip_count}, エラー:{error_count})")
+                # ログ全体の結合は件数に比例するので、表示の更新は EVENT_INTERVAL ごとにまとめる
+                if updated and time.monotonic() - last_yield >= EVENT_INTERVAL:
+                    yield header_text + '\n'.join(status_logs)
+                    last_yield = time.monotonic()
+                    updated = False
+        except BaseException:
+            # 画面側で処理が中断された場合などは、まだ始まっていないダウンロードを取り消し、
+            # 転送中のワーカーには中止を伝えて一時ファイルを消させる（終了は待たない）
+            cancel.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        executor.shutdown()
+
     # 最終結果のサマリー
     total_time = time.time() - start_time
     
-    # エラーがあった場合はエラー詳細を先に表示
-    if error_details:
-        logs.extend(['=== エラー詳細 ==='])
-        logs.extend(error_details)
+    # 最終ログは中間リストを作らずに直接書き出す
+    out = io.StringIO()
+    for line in logs:
+        out.write(line + '\n')
+    out.write('=== 処理状況 ===\n')
+    for line in status_logs:
+        out.write(line + '\n')
+    out.write('\n')
+
+    # エラーがあった場合はエラー詳細を先に表示（URLの順番で並べる）
+    if error_logs:
+        out.write('=== エラー詳細 ===\n')
+        for idx in sorted(error_logs):
+            for line in error_logs[idx]:
+                out.write(line + '\n')
+            out.write('\n')  # 空行で区切り
     
-    logs.extend([
+    summary = [
         '=== ダウンロード結果 ===',
         f'終了時刻: {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}',
         f'処理時間: {format_duration(total_time)}',
@@ -329,21 +695,27 @@ def batch_download(txt_file, url_text, dest_dir, skip_existing=True, retry_count
         f'合計: {len(urls)}件',
         f'ダウンロード量: {format_file_size(total_downloaded_size)}',
         ''
-    ])
+    ]
     
     if error_count > 0:
-        logs.append('※ エラーが発生したURLがあります。上記エラー詳細で原因を確認してください。')
+        summary.append('※ エラーが発生したURLがあります。上記エラー詳細で原因を確認してください。')
+    
+    for line in summary:
+        out.write(line + '\n')
     
     progress(1.0, "完了")
-    return '\n'.join(logs)
+    yield out.getvalue()
 
 # --- Gradio UI ---
 def ui():
+    # WebUI起動時ではなくタブ作成時に読み込む
+    import gradio as gr
+
     with gr.Blocks(analytics_enabled=False) as demo:
         gr.Markdown('## URL Scooop: 一括ダウンロード')
         gr.Markdown('### CivitAI対応: モデルページのURLを自動的にダウンロードAPIのURLに変換します')
         with gr.Row():
-            txt_file = gr.File(label='URLリスト(.txt)', file_types=['.txt'])
+            txt_file = gr.File(label='URLリスト(.txt / .jsonl)', file_types=['.txt', '.jsonl'])
             url_text = gr.Textbox(
                 label='URLリスト(改行区切り) - CivitAIのモデルページURLを貼ってください', 
                 lines=4,
@@ -352,6 +724,7 @@ def ui():
         dest_dir = gr.Textbox(label='保存先フォルダ', placeholder='/path/to/output')
         with gr.Row():
             skip_existing = gr.Checkbox(label='既存ファイルをスキップ', value=True)
+            max_workers = gr.Slider(minimum=1, maximum=10, value=MAX_WORKERS, step=1, label='同時ダウンロード数')
             download_mode = gr.Radio(
                 choices=[
                     "標準 (リトライ3回, 間隔1秒) - 一般的な用途",
@@ -376,7 +749,7 @@ def ui():
         btn = gr.Button('ダウンロード開始')
         log_output = gr.Textbox(label='ログ', lines=20)
         
-        def start_download(txt_file, url_text, dest_dir, skip_existing, mode, retry_count, delay_seconds, progress=gr.Progress()):
+        def start_download(txt_file, url_text, dest_dir, skip_existing, max_workers, mode, retry_count, delay_seconds, progress=gr.Progress()):
             # モードから設定を決定
             if mode.startswith("標準"):
                 retry_count, delay_seconds = 3, 1
@@ -386,9 +759,10 @@ def ui():
                 retry_count, delay_seconds = 1, 0.5
             # カスタムの場合はそのまま使用
             
-            return batch_download(txt_file, url_text, dest_dir, skip_existing, retry_count, delay_seconds, progress)
+            yield from batch_download(txt_file, url_text, dest_dir, skip_existing, retry_count, delay_seconds, max_workers, progress)
         
-        btn.click(start_download, [txt_file, url_text, dest_dir, skip_existing, download_mode, retry_count, delay_seconds], log_output)
+        # 長時間のバッチでもUIを止めないよう、キュー経由でストリーミング実行する
+        btn.click(start_download, [txt_file, url_text, dest_dir, skip_existing, max_workers, download_mode, retry_count, delay_seconds], log_output, queue=True)
     return demo
 
 # WebUI にタブ追加